@@ -1,121 +1,193 @@
-from json import load as json_load
-from logging import INFO, getLogger, info
-from os.path import join
-from pathlib import Path
-from sys import version_info
-
-from pyglet import app, image
-from pyglet.gl import *
-from pyglet.graphics import TextureGroup
-
-from constants import *
-from window import Window
-
-
-if (*version_info,) < (3, 10):
-    raise Exception('This project requires at least Python 3.10 to execute!')
-
-if USE_LOG:
-    getLogger().setLevel(INFO)
-
-info('Loading Assets...')
-
-TEXTURES = {}
-MODELS = {}
-
-
-def init_data(namespace: str):
-    """
-    Load vanilla minecraft data.
-
-    Parameters
-    ----------
-    namespace : namespace in the assets folder
-    """
-
-    info('Assets: Loading models...')
-    for folder in Path(join('assets', namespace, 'models')).iterdir():
-        if not folder.is_dir():
-            continue
-        for file in folder.iterdir():
-            if not file.is_file():
-                continue
-            if file.suffix != '.json':
-                continue
-            with open(file) as model:
-                MODELS[f'{namespace}:{folder.name}/{file.name.rstrip(file.suffix)}'] = \
-                    json_load(model)
-
-    info('Assets: Loading textures...')
-    for folder in Path(join('assets', namespace, 'textures')).iterdir():
-        if not folder.is_dir():
-            continue
-        for file in folder.iterdir():
-            if not file.is_file():
-                continue
-            if file.suffix != '.png':
-                continue
-            TEXTURES[f'{namespace}:{folder.name}/{file.name.rstrip(file.suffix)}'] = \
-                TextureGroup(image.load(file).get_texture())
-
-        for subfolder in folder.iterdir():
-            if not subfolder.is_dir():
-                continue
-            for file in subfolder.iterdir():
-                if not file.is_file():
-                    continue
-                if file.suffix != '.png':
-                    continue
-                TEXTURES[f'{namespace}:{folder.name}/{subfolder.name}/{file.name.rstrip(file.suffix)}'] = \
-                    TextureGroup(image.load(file).get_texture())
-
-
-init_data(NAMESPACE)
-
-info('Loaded Assets!')
-
-
-def setup_fog():
-    'Configure the OpenGL fog properties.'
-    # Enable fog. Fog "blends a fog color with each
-    # rasterized pixel fragment's post-texturing color."
-    glEnable(GL_FOG)
-    # transparency
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-    # Set the fog color.
-    glFogfv(GL_FOG_COLOR, (GLfloat * 4)(0.47, 0.65, 1.0, 1))
-    # Say we have no preference between rendering speed and quality.
-    glHint(GL_FOG_HINT, GL_DONT_CARE)
-    # Specify the equation used to compute the blending factor.
-    glFogi(GL_FOG_MODE, GL_LINEAR)
-    # How close and far away fog starts and ends. The closer the start and end,
-    # the denser the fog in the fog range.
-    glFogf(GL_FOG_START, 20)
-    glFogf(GL_FOG_END, 60)
-
-
-def setup():
-    'Basic OpenGL configuration.'
-    # Set the color of "clear", i.e. the sky, in rgba.
-    glClearColor(0.47, 0.65, 1.0, 1)
-    # Enable culling (not rendering) of back-facing facets -- facets that aren't
-    # visible to you.
-    glEnable(GL_CULL_FACE)
-    # Set the texture minification/magnification function to GL_NEAREST (nearest
-    # in Manhattan distance) to the specified texture coordinates. GL_NEAREST
-    # "is generally faster than GL_LINEAR, but it can produce textured images
-    # with sharper edges because the transition between texture elements is not
-    # as smooth."
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-    setup_fog()
-
-
-def main():
-    window = Window(width=800, height=600,
-                    caption='Minecraft Python', resizable=True)
-    # Hide the mouse cursor and prevent the mouse from leaving the window.
-    window.set_exclusive_mouse(True)
-    setup()
-    app.run()
+from concurrent.futures import ThreadPoolExecutor
+from logging import INFO, getLogger, info
+from os.path import join
+from pathlib import Path
+from sys import version_info
+
+import numpy as np
+from orjson import loads as json_loads
+from pyglet import app, image
+from pyglet.gl import *
+from pyglet.image import ImageData, Texture
+
+from constants import *
+from functions import pack_textures
+from utils import *
+from window import Window
+
+
+if (*version_info,) < (3, 10):
+    raise Exception('This project requires at least Python 3.10 to execute!')
+
+if USE_LOG:
+    getLogger().setLevel(INFO)
+
+info('Loading Assets...')
+
+
+def load_model(models: LazyDict, key: str):
+    'Parse the model JSON registered for `key`.'
+    models[key] = json_loads(models.sources[key].read_bytes())
+
+
+def load_atlas(textures: LazyDict, key: str):
+    'Build the atlas of the texture folder that `key` belongs to.'
+    name = textures.sources[key]
+    paths = ATLAS_SOURCES[name]
+    info(f'Assets: Loading the {name} atlas...')
+    # Only decoding is done on worker threads. Composing the atlas and the
+    # one texture upload happen on this thread, since OpenGL calls have to
+    # happen on the thread of the context.
+    with ThreadPoolExecutor() as executor:
+        images = executor.map(decode_texture, paths.values())
+        build_atlas(name, *compose_atlas(dict(zip(paths, images))))
+
+
+# The textures of every folder are packed into one shared atlas so that
+# consumers can draw many different textures with a single texture bind.
+# Models and atlases are only loaded the first time they are looked up.
+ATLASES: dict[str, Texture] = {}
+ATLAS_SOURCES: dict[str, dict[str, Path]] = {}
+TEXTURES = LazyDict(load_atlas)
+MODELS = LazyDict(load_model)
+
+
+def decode_texture(path: Path) -> np.ndarray:
+    'Decode the image at `path` into an array of RGBA rows, bottom row first.'
+    img = image.load(path).get_image_data()
+    return np.frombuffer(img.get_data('RGBA', img.width * 4), dtype=np.uint8) \
+        .reshape(img.height, img.width, 4)
+
+
+def compose_atlas(images: dict[str, np.ndarray]) -> tuple[np.ndarray, dict[str, tuple[int]]]:
+    """
+    Pack `images` and copy their pixels into one atlas sized pixel buffer.
+
+    Parameters
+    ----------
+    images : mapping from texture key to the decoded pixels
+
+    Returns
+    -------
+    pixels : uint8 ndarray of shape (size, size, 4)
+    regions : mapping from texture key to its (x, y, width, height)
+    """
+
+    size, offsets = pack_textures(
+        {key: (pixels.shape[1], pixels.shape[0]) for key, pixels in images.items()})
+    atlas = np.zeros((size, size, 4), dtype=np.uint8)
+    regions = {}
+    for key, (x, y) in offsets.items():
+        height, width, _ = images[key].shape
+        atlas[y:y + height, x:x + width] = images[key]
+        regions[key] = x, y, width, height
+    return atlas, regions
+
+
+def build_atlas(name: str, pixels: np.ndarray, regions: dict[str, tuple[int]]):
+    """
+    Upload a composed atlas as one texture and register its regions in
+    TEXTURES.
+
+    Parameters
+    ----------
+    name : key of the atlas in ATLASES
+    pixels : pixel buffer from `compose_atlas()`
+    regions : regions from `compose_atlas()`
+    """
+
+    size = len(pixels)
+    atlas = ImageData(size, size, 'RGBA', pixels.tobytes()).get_texture()
+    for key, region in regions.items():
+        TEXTURES[key] = atlas.get_region(*region)
+    ATLASES[name] = atlas
+
+
+def init_data(namespace: str):
+    """
+    Register vanilla minecraft data, to be loaded on first use.
+
+    Parameters
+    ----------
+    namespace : namespace in the assets folder
+    """
+
+    info('Assets: Indexing models...')
+    for folder in Path(join('assets', namespace, 'models')).iterdir():
+        if not folder.is_dir():
+            continue
+        for file in folder.iterdir():
+            if not file.is_file():
+                continue
+            if file.suffix != '.json':
+                continue
+            MODELS.sources[f'{namespace}:{folder.name}/{file.stem}'] = file
+
+    info('Assets: Indexing textures...')
+    for folder in Path(join('assets', namespace, 'textures')).iterdir():
+        if not folder.is_dir():
+            continue
+        name = f'{namespace}:{folder.name}'
+        paths = ATLAS_SOURCES[name] = {}
+        for entry in folder.iterdir():
+            if entry.is_file() and entry.suffix == '.png':
+                paths[f'{namespace}:{folder.name}/{entry.stem}'] = entry
+            elif entry.is_dir():
+                for file in entry.iterdir():
+                    if not file.is_file():
+                        continue
+                    if file.suffix != '.png':
+                        continue
+                    paths[f'{namespace}:{folder.name}/{entry.name}/{file.stem}'] = file
+        TEXTURES.sources.update(dict.fromkeys(paths, name))
+
+
+init_data(NAMESPACE)
+
+info('Loaded Assets!')
+
+
+def setup_fog():
+    'Configure the OpenGL fog properties.'
+    # Enable fog. Fog "blends a fog color with each
+    # rasterized pixel fragment's post-texturing color."
+    glEnable(GL_FOG)
+    # transparency
+    glEnable(GL_BLEND)
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+    # Set the fog color.
+    glFogfv(GL_FOG_COLOR, (GLfloat * 4)(0.47, 0.65, 1.0, 1))
+    # Say we have no preference between rendering speed and quality.
+    glHint(GL_FOG_HINT, GL_DONT_CARE)
+    # Specify the equation used to compute the blending factor.
+    glFogi(GL_FOG_MODE, GL_LINEAR)
+    # How close and far away fog starts and ends. The closer the start and end,
+    # the denser the fog in the fog range.
+    glFogf(GL_FOG_START, 20)
+    glFogf(GL_FOG_END, 60)
+
+
+def setup():
+    'Basic OpenGL configuration.'
+    # Set the color of "clear", i.e. the sky, in rgba.
+    glClearColor(0.47, 0.65, 1.0, 1)
+    # Enable culling (not rendering) of back-facing facets -- facets that aren't
+    # visible to you.
+    glEnable(GL_CULL_FACE)
+    # Set the texture minification/magnification function to GL_NEAREST (nearest
+    # in Manhattan distance) to the specified texture coordinates. GL_NEAREST
+    # "is generally faster than GL_LINEAR, but it can produce textured images
+    # with sharper edges because the transition between texture elements is not
+    # as smooth."
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    setup_fog()
+
+
+def main():
+    window = Window(width=800, height=600,
+                    caption='Minecraft Python', resizable=True)
+    # Hide the mouse cursor and prevent the mouse from leaving the window.
+    window.set_exclusive_mouse(True)
+    setup()
+    app.run()
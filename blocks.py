@@ -1,10 +1,16 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from math import floor, inf
+from zlib import compress, decompress
 
+import numpy as np
 
-@dataclass
+from constants import *
+
+
+@dataclass(slots=True)
 class Block:
     id: str = 'air'
-    state: dict[str, tuple[bool | int | str, set[bool | int | str]]] = {}
+    state: dict[str, tuple[bool | int | str, set[bool | int | str]]] = field(default_factory=dict)
 
 
 DEFAULT_BLOCKS = [
@@ -631,65 +637,65 @@ DEFAULT_BLOCKS = [
     Block('farmland',
           {'moisture': (0, {*range(8)})}),
     Block('oak_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('spruce_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('birch_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('jungle_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('acacia_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('dark_oak_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('mangrove_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('crimson_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('warped_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('nether_brick_fence',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('oak_fence_gate',
           {'facing': ('north', {'east', 'south', 'west', 'north'}),
            'in_wall': (False, {True, False}),
@@ -796,107 +802,107 @@ DEFAULT_BLOCKS = [
     Block('red_stained_glass'),
     Block('black_stained_glass'),
     Block('glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('white_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('orange_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('magenta_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('light_blue_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('yellow_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('lime_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('pink_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('gray_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('light_gray_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('cyan_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('purple_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('blue_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('brown_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('green_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('red_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('black_stained_glass_pane',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('white_glazed_terracotta',
           {'facing': ('north', {'east', 'south', 'west', 'north'})}),
     Block('orange_glazed_terracotta',
@@ -994,11 +1000,11 @@ DEFAULT_BLOCKS = [
     Block('infested_chiseled_stone_bricks'),
     Block('infested_deepslate'),
     Block('iron_bars',
-          {'east', (False, {True, False}),
-           'south', (False, {True, False}),
-           'west', (False, {True, False}),
-           'north', (False, {True, False}),
-           'waterlogged', (False, {True, False})}),
+          {'east': (False, {True, False}),
+           'south': (False, {True, False}),
+           'west': (False, {True, False}),
+           'north': (False, {True, False}),
+           'waterlogged': (False, {True, False})}),
     Block('iron_ore'),
     Block('deepslate_iron_ore'),
     Block('jukebox',
@@ -1018,7 +1024,7 @@ DEFAULT_BLOCKS = [
     Block('lapis_ore'),
     Block('deepslate_lapis_ore'),
     Block('flowing_lava',
-          {'level', (0, {*range(16)})}),
+          {'level': (0, {*range(16)})}),
     Block('lava'),
     Block('oak_leaves',
           {'distance': (7, range(1, 7)),
@@ -1314,7 +1320,7 @@ DEFAULT_BLOCKS = [
            'waterlogged': (False, {True, False})}),
     Block('sculk'),
     Block('sculk_catalyst',
-          {'bloom', (False, {True, False})}),
+          {'bloom': (False, {True, False})}),
     Block('sculk_sensor',
           {'power': (0, {*range(16)}),
            'sculk_sensor_phase': ('cooldown', {'active', 'cooldown', 'inactive'}),
@@ -2094,7 +2100,7 @@ DEFAULT_BLOCKS = [
            'up': (False, {True, False}),
            'waterlogged': (False, {True, False})}),
     Block('flowing_water',
-          {'level', (0, {*range(16)})}),
+          {'level': (0, {*range(16)})}),
     Block('water'),
     Block('weeping_vines',
           {'age': (0, {*range(26)})}),
@@ -2154,3 +2160,398 @@ DEFAULT_BLOCKS = [
     Block('red_wool'),
     Block('black_wool'),
 ]
+
+# Mapping between block names and the ids stored in chunks, id 0 being air.
+BLOCK_NAMES: list[str] = ['air', *dict.fromkeys(block.id for block in DEFAULT_BLOCKS)]
+BLOCK_IDS: dict[str, int] = {name: i for i, name in enumerate(BLOCK_NAMES)}
+# Smallest integer type able to hold every block id.
+BLOCK_DTYPE: type = np.uint8 if len(BLOCK_NAMES) <= 256 else np.uint16
+
+
+class Chunk:
+    """
+    A CHUNK_SIZE x WORLD_HEIGHT x CHUNK_SIZE column of the world, stored as an
+    array of block ids indexed by the x, y, z position inside the chunk.
+    """
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids: None | np.ndarray = None):
+        self.ids: np.ndarray = np.zeros(
+            (CHUNK_SIZE, WORLD_HEIGHT, CHUNK_SIZE), dtype=BLOCK_DTYPE) if ids is None else ids
+
+    def pack(self) -> bytes:
+        'Returns the block ids of the chunk, compressed.'
+        return compress(self.ids.tobytes(), 1)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'Chunk':
+        'Returns the chunk packed into `data` by `pack()`.'
+        return cls(np.frombuffer(bytearray(decompress(data)), dtype=BLOCK_DTYPE)
+                   .reshape(CHUNK_SIZE, WORLD_HEIGHT, CHUNK_SIZE))
+
+
+def _ray_axis(p: float, d: float) -> tuple:
+    """
+    Returns the starting block, step, distance to the first boundary and
+    distance between boundaries along one axis of a ray, where `p` is the
+    start and `d` the direction of the ray along that axis.
+    """
+
+    p += 0.5
+    i = floor(p)
+    if d > 0:
+        return i, 1, (i + 1 - p) / d, 1 / d
+    elif d < 0:
+        return i, -1, (p - i) / -d, -1 / d
+    return i, 0, inf, inf
+
+
+class World:
+    """
+    Mapping from position to the name of the block at that position. Blocks
+    are stored in chunks, keyed the same way as sectors. Chunks far from the
+    player are kept packed, and unpacked again when they are accessed.
+    """
+
+    __slots__ = ('chunks', 'packed')
+
+    def __init__(self):
+        # Mapping from sector to the chunk holding its blocks.
+        self.chunks: dict[tuple[int], Chunk] = {}
+
+        # Mapping from sector to the packed chunk of sectors far away.
+        self.packed: dict[tuple[int], bytes] = {}
+
+    def get_chunk(self, sector: tuple[int]) -> None | Chunk:
+        """
+        Returns the chunk of `sector`, unpacking it first if it is packed, or
+        None if the sector has no chunk.
+        """
+
+        chunk = self.chunks.get(sector)
+        if chunk is None and sector in self.packed:
+            chunk = self.chunks[sector] = Chunk.unpack(self.packed.pop(sector))
+        return chunk
+
+    def pack_far(self, sector: tuple[int], distance: int):
+        """
+        Pack the chunks more than `distance` sectors away from `sector` along
+        x or z, to save memory.
+        """
+
+        x, _, z = sector
+        for key in [key for key in self.chunks
+                    if abs(key[0] - x) > distance or abs(key[2] - z) > distance]:
+            self.packed[key] = self.chunks.pop(key).pack()
+
+    def __contains__(self, position: tuple[int]) -> bool:
+        x, y, z = position
+        if not 0 <= y < WORLD_HEIGHT:
+            return False
+        chunk = self.get_chunk((x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT))
+        return chunk is not None and chunk.ids.item(x & CHUNK_MASK, y, z & CHUNK_MASK) != 0
+
+    def __getitem__(self, position: tuple[int]) -> str:
+        x, y, z = position
+        if not 0 <= y < WORLD_HEIGHT:
+            raise KeyError(position)
+        chunk = self.get_chunk((x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT))
+        if chunk is None or not (block := chunk.ids.item(x & CHUNK_MASK, y, z & CHUNK_MASK)):
+            raise KeyError(position)
+        return BLOCK_NAMES[block]
+
+    def __setitem__(self, position: tuple[int], name: str):
+        x, y, z = position
+        if not 0 <= y < WORLD_HEIGHT:
+            raise IndexError(f'Height {y} is outside of the world')
+        sector = x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT
+        if (chunk := self.get_chunk(sector)) is None:
+            chunk = self.chunks[sector] = Chunk()
+        chunk.ids[x & CHUNK_MASK, y, z & CHUNK_MASK] = BLOCK_IDS[name]
+
+    def fill_columns(self, x: int, z: int, heights: np.ndarray,
+                     bottom: str, middle: str, top: str):
+        """
+        Fill the columns of a height map, one chunk at a time. Every column
+        gets `bottom` at height 0, `middle` above it and `top` at the height
+        of the column. Heights outside of the world are ignored.
+
+        Parameters
+        ----------
+        x, z : int
+            The horizontal position of the first column of `heights`.
+        heights : int ndarray of shape (W, D)
+            The height of the column at x + i, z + k for each i, k.
+        bottom, middle, top : string
+            IDs of the blocks.
+        """
+
+        width, depth = heights.shape
+        levels = np.arange(WORLD_HEIGHT)[None, :, None]
+        for chunk_x in range(x >> CHUNK_SHIFT, (x + width - 1 >> CHUNK_SHIFT) + 1):
+            for chunk_z in range(z >> CHUNK_SHIFT, (z + depth - 1 >> CHUNK_SHIFT) + 1):
+                # The part of the height map inside this chunk, in world and
+                # in chunk coordinates.
+                x0 = max(x, chunk_x << CHUNK_SHIFT)
+                x1 = min(x + width, chunk_x + 1 << CHUNK_SHIFT)
+                z0 = max(z, chunk_z << CHUNK_SHIFT)
+                z1 = min(z + depth, chunk_z + 1 << CHUNK_SHIFT)
+                column = heights[x0 - x:x1 - x, None, z0 - z:z1 - z]
+                # Nothing is set above the highest column.
+                stop = min(max(int(column.max()) + 1, 1), WORLD_HEIGHT)
+                below = levels[:, :stop]
+                ids = np.select(
+                    [below == column, (below >= 1) & (below < column), below == 0],
+                    [BLOCK_IDS[top], BLOCK_IDS[middle], BLOCK_IDS[bottom]]).astype(BLOCK_DTYPE)
+                sector = chunk_x, 0, chunk_z
+                if (chunk := self.get_chunk(sector)) is None:
+                    chunk = self.chunks[sector] = Chunk()
+                target = chunk.ids[x0 & CHUNK_MASK:(x1 - 1 & CHUNK_MASK) + 1, :stop,
+                                   z0 & CHUNK_MASK:(z1 - 1 & CHUNK_MASK) + 1]
+                np.copyto(target, ids, where=ids != 0)
+
+    def has_blocks(self, x: int, z: int, start: int, stop: int) -> bool:
+        """
+        Returns whether there is any block in the column at `x`, `z` from
+        height `start` up to, but not including, height `stop`.
+        """
+
+        sector = x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT
+        chunk = self.chunks.get(sector) or self.get_chunk(sector)
+        if chunk is None:
+            return False
+        # Columns are short, so reading single items beats slicing.
+        ids, i, k = chunk.ids, x & CHUNK_MASK, z & CHUNK_MASK
+        for y in range(max(start, 0), min(stop, WORLD_HEIGHT)):
+            if ids.item(i, y, k):
+                return True
+        return False
+
+    def column_top(self, x: int, z: int) -> int:
+        """
+        Returns the height just above the highest block in the column at
+        `x`, `z`, or 0 if the column is empty.
+        """
+
+        chunk = self.get_chunk((x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT))
+        if chunk is None:
+            return 0
+        filled = np.flatnonzero(chunk.ids[x & CHUNK_MASK, :, z & CHUNK_MASK])
+        return int(filled[-1]) + 1 if len(filled) else 0
+
+    def collide(self, position: tuple[float], height: int,
+                pad: float) -> tuple[tuple[float], bool]:
+        """
+        Push a player of `height` blocks at `position` out of the blocks
+        around it. A block only counts when the player overlaps it by more
+        than `pad`.
+
+        Parameters
+        ----------
+        position : tuple of len 3
+            The (x, y, z) position of the player.
+        height : int or float
+            The height of the player.
+        pad : float
+            How much overlap with a block counts as a collision.
+
+        Returns
+        -------
+        position : tuple of len 3
+            The new position of the player.
+        vertical : bool
+            Whether the player hit a floor or a ceiling.
+        """
+
+        px, py, pz = position
+        bx, by, bz = floor(px + 0.5), floor(py + 0.5), floor(pz + 0.5)
+        # The blocks next to the player, from its feet up to its head.
+        low, high = by - floor(height) + 1, by + 1
+        vertical = False
+        # Each axis is checked on its own, in FACES order, and only the side
+        # the player leans towards can overlap the next block by more than
+        # the padding. Only the coordinate along an axis is pushed by it, so
+        # the axes do not depend on each other.
+        d = py - by
+        if d >= pad:
+            if self.has_blocks(bx, bz, low + 1, high + 1):
+                py -= d - pad
+                vertical = True
+        elif d <= -pad:
+            if self.has_blocks(bx, bz, low - 1, high - 1):
+                py -= d + pad
+                vertical = True
+        d = px - bx
+        if d >= pad:
+            if self.has_blocks(bx + 1, bz, low, high):
+                px -= d - pad
+        elif d <= -pad:
+            if self.has_blocks(bx - 1, bz, low, high):
+                px -= d + pad
+        d = pz - bz
+        if d >= pad:
+            if self.has_blocks(bx, bz + 1, low, high):
+                pz -= d - pad
+        elif d <= -pad:
+            if self.has_blocks(bx, bz - 1, low, high):
+                pz -= d + pad
+        return (px, py, pz), vertical
+
+    def __delitem__(self, position: tuple[int]):
+        x, y, z = position
+        if not 0 <= y < WORLD_HEIGHT:
+            raise KeyError(position)
+        chunk = self.get_chunk((x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT))
+        index = x & CHUNK_MASK, y, z & CHUNK_MASK
+        if chunk is None or not chunk.ids.item(index):
+            raise KeyError(position)
+        chunk.ids[index] = 0
+
+    def exposed(self, position: tuple[int]) -> bool:
+        """
+        Returns False if given `position` is surrounded on all 6 sides by
+        blocks, True otherwise. Neighbors inside the same chunk are read
+        straight from its array.
+        """
+
+        x, y, z = position
+        i, k = x & CHUNK_MASK, z & CHUNK_MASK
+        chunk = self.get_chunk((x >> CHUNK_SHIFT, 0, z >> CHUNK_SHIFT))
+        if chunk is None or not (0 < i < CHUNK_MASK and 0 < k < CHUNK_MASK
+                                 and 0 < y < WORLD_HEIGHT - 1):
+            return any((x + dx, y + dy, z + dz) not in self for dx, dy, dz in FACES)
+        ids = chunk.ids
+        return not (ids.item(i, y + 1, k) and ids.item(i, y - 1, k)
+                    and ids.item(i - 1, y, k) and ids.item(i + 1, y, k)
+                    and ids.item(i, y, k + 1) and ids.item(i, y, k - 1))
+
+    def raycast(self, position: tuple[float], vector: tuple[float],
+                max_distance: float) -> tuple[None | tuple[int]]:
+        """
+        Returns the first block hit by the ray from `position` along
+        `vector`, along with the block the ray passed through before it, or
+        None, None if no block is hit within `max_distance`.
+        """
+
+        # Walk the blocks along the ray one boundary crossing at a time
+        # (Amanatides & Woo). Blocks are centered on integers, so their
+        # boundaries are at integers in coordinates shifted by 0.5. The chunk
+        # is only looked up again when the ray leaves it.
+        (x, sx, tx, dx), (y, sy, ty, dy), (z, sz, tz, dz) = map(_ray_axis, position, vector)
+        previous = None
+        chunk_x = chunk_z = item = None
+        while True:
+            if x >> CHUNK_SHIFT != chunk_x or z >> CHUNK_SHIFT != chunk_z:
+                chunk_x, chunk_z = x >> CHUNK_SHIFT, z >> CHUNK_SHIFT
+                chunk = self.get_chunk((chunk_x, 0, chunk_z))
+                item = None if chunk is None else chunk.ids.item
+            if item is not None and 0 <= y < WORLD_HEIGHT and item(x & CHUNK_MASK, y, z & CHUNK_MASK):
+                return (x, y, z), previous
+            previous = x, y, z
+            if (y < 0 and sy <= 0) or (y >= WORLD_HEIGHT and sy >= 0):
+                # The ray left the world height and is not coming back.
+                return None, None
+            if tx <= ty and tx <= tz:
+                if tx >= max_distance:
+                    return None, None
+                x += sx
+                tx += dx
+            elif ty <= tz:
+                if ty >= max_distance:
+                    return None, None
+                y += sy
+                ty += dy
+            else:
+                if tz >= max_distance:
+                    return None, None
+                z += sz
+                tz += dz
+
+    def padded(self, sector: tuple[int], start: int = 0, stop: int = WORLD_HEIGHT) -> np.ndarray:
+        """
+        Returns the block ids of `sector` from height `start` up to, but not
+        including, height `stop`, with a border one block wide on every
+        side, taken from the neighboring chunks, the layers above and below,
+        or air.
+
+        Parameters
+        ----------
+        sector : tuple of len 3
+        start, stop : int
+            The range of heights to return.
+
+        Returns
+        -------
+        ids : ndarray of shape (CHUNK_SIZE + 2, stop - start + 2, CHUNK_SIZE + 2)
+        """
+
+        ids = np.zeros((CHUNK_SIZE + 2, stop - start + 2, CHUNK_SIZE + 2), dtype=BLOCK_DTYPE)
+        # Only the layers inside the world are copied, the others stay air.
+        low, high = max(start - 1, 0), min(stop + 1, WORLD_HEIGHT)
+        rows = slice(low - start + 1, high - start + 1)
+        x, _, z = sector
+        if (chunk := self.get_chunk(sector)) is not None:
+            ids[1:-1, rows, 1:-1] = chunk.ids[:, low:high]
+        if (chunk := self.get_chunk((x - 1, 0, z))) is not None:
+            ids[0, rows, 1:-1] = chunk.ids[-1, low:high]
+        if (chunk := self.get_chunk((x + 1, 0, z))) is not None:
+            ids[-1, rows, 1:-1] = chunk.ids[0, low:high]
+        if (chunk := self.get_chunk((x, 0, z - 1))) is not None:
+            ids[1:-1, rows, 0] = chunk.ids[:, low:high, -1]
+        if (chunk := self.get_chunk((x, 0, z + 1))) is not None:
+            ids[1:-1, rows, -1] = chunk.ids[:, low:high, 0]
+        return ids
+
+    def exposed_faces(self, sector: tuple[int]) -> tuple[np.ndarray]:
+        """
+        Returns every face of the blocks inside `sector` that is not covered
+        by a neighboring block or the bottom of the world, along with the id
+        of its block.
+
+        Parameters
+        ----------
+        sector : tuple of len 3
+
+        Returns
+        -------
+        faces : int ndarray of shape (N, 4)
+            The (x, y, z, face) of each face, face being an index in FACES.
+        ids : ndarray of shape (N,)
+        """
+
+        chunk = self.get_chunk(sector)
+        # Reducing the x axis first works on whole contiguous slabs of the
+        # chunk, which is many times faster than reducing x and z at once.
+        heights = np.flatnonzero(chunk.ids.max(axis=0).max(axis=1)) if chunk is not None else ()
+        if not len(heights):
+            return np.empty((0, 4), dtype=np.int64), np.empty(0, dtype=BLOCK_DTYPE)
+        # Only look at the heights that have blocks, plus the border.
+        bottom, top = heights[0], heights[-1] + 3
+        ids = self.padded(sector, bottom, top - 2)
+        solid = ids != 0
+        if bottom == 0:
+            # The terrain always sits on the bottom of the world, which is
+            # never seen from inside it, so nothing faces below the world.
+            solid[:, 0] = True
+        # Layers full across the chunk and its border hide the layers below
+        # them, so the stencil starts under the first one with a gap, which
+        # skips the buried bulk of the terrain.
+        full = solid[1:-1, :, 1:-1].min(axis=0).min(axis=1) \
+            & solid[0, :, 1:-1].all(axis=1) & solid[-1, :, 1:-1].all(axis=1) \
+            & solid[1:-1, :, 0].all(axis=0) & solid[1:-1, :, -1].all(axis=0)
+        skip = max(0, int(np.argmin(full)) - 2)
+        ids, solid, bottom = ids[:, skip:], solid[:, skip:], bottom + skip
+        inner = solid[1:-1, 1:-1, 1:-1]
+        size, height = CHUNK_SIZE, top - bottom - 2
+        exposed = np.stack([
+            inner & ~solid[1 + dx:1 + dx + size, 1 + dy:1 + dy + height, 1 + dz:1 + dz + size]
+            for dx, dy, dz in FACES
+        ], axis=-1)
+        # Much faster than np.argwhere, for the same faces in the same order.
+        faces = np.column_stack(np.unravel_index(np.flatnonzero(exposed), exposed.shape))
+        ids = ids[faces[:, 0] + 1, faces[:, 1] + 1, faces[:, 2] + 1]
+        faces[:, 0] += sector[0] * CHUNK_SIZE
+        faces[:, 1] += bottom
+        faces[:, 2] += sector[2] * CHUNK_SIZE
+        return faces, ids
@@ -7,6 +7,12 @@ FACES = [
 TICKS_PER_SEC = 60
 
 CHUNK_SIZE = 16
+# Chunk coordinates are computed with shifts and masks, so CHUNK_SIZE has to
+# be a power of two.
+CHUNK_SHIFT = CHUNK_SIZE.bit_length() - 1
+CHUNK_MASK = CHUNK_SIZE - 1
+assert CHUNK_SIZE == 1 << CHUNK_SHIFT, 'CHUNK_SIZE must be a power of two'
+WORLD_HEIGHT = 256
 
 WALKING_SPEED = 4.317
 SPRINTING_SPEED = 5.612
@@ -1,22 +1,183 @@
+from functools import lru_cache
+from math import floor
+
+import numpy as np
+
 from constants import *
 from utils import *
 
 
 __all__ = [
-    'cube_vertices', 'normalize', 'sectorize', 'tex_coord', 'tex_coords',
+    'CUBE_INDICES', 'boxes_in_frustum', 'cube_corners_into', 'face_tiles',
+    'frustum_planes', 'greedy_quads', 'normalize', 'pack_textures',
+    'quad_tex_coords_batch', 'quad_vertices_batch', 'sectorize',
+]
+
+# Signs of the offsets from the cube center for each of the 24 vertices,
+# one row per vertex in face order top, bottom, left, right, front, back,
+# which is the order of FACES.
+_CUBE_SIGNS = np.array([
+    [-1,  1, -1], [-1,  1,  1], [ 1,  1,  1], [ 1,  1, -1],  # top
+    [-1, -1, -1], [ 1, -1, -1], [ 1, -1,  1], [-1, -1,  1],  # bottom
+    [-1, -1, -1], [-1, -1,  1], [-1,  1,  1], [-1,  1, -1],  # left
+    [ 1, -1,  1], [ 1, -1, -1], [ 1,  1, -1], [ 1,  1,  1],  # right
+    [-1, -1,  1], [ 1, -1,  1], [ 1,  1,  1], [-1,  1,  1],  # front
+    [ 1, -1, -1], [-1, -1, -1], [-1,  1, -1], [ 1,  1, -1],  # back
+], dtype=np.int8)
+_CUBE_SIGNS.flags.writeable = False
+
+# The 8 corners of the cube, and the corner of each of the 24 vertices, for
+# drawing cubes without texture coordinates with shared vertices.
+_CUBE_CORNER_SIGNS, CUBE_INDICES = np.unique(_CUBE_SIGNS, axis=0, return_inverse=True)
+_CUBE_CORNER_SIGNS.flags.writeable = False
+CUBE_INDICES: list[int] = CUBE_INDICES.ravel().tolist()
+
+# Texture coordinates of the 4 vertices of a face, counterclockwise from the
+# bottom left, and for each face the axes along which they change.
+_FACE_UVS = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+_FACE_UV_AXES = np.array([
+    [np.flatnonzero(signs[0] != signs[1])[0], np.flatnonzero(signs[1] != signs[2])[0]]
+    for signs in _CUBE_SIGNS.reshape(6, 4, 3)
+])
+_FACE_UV_AXES.flags.writeable = False
+# The one block steps along those axes, for walking over the faces of a plane.
+_FACE_UV_STEPS: list[tuple[tuple[int]]] = [
+    tuple(tuple(int(i == axis) for i in range(3)) for axis in axes)
+    for axes in _FACE_UV_AXES.tolist()
 ]
+# Whether each vertex of each face is on the far side of its block along each
+# axis, which is the side that moves when a face is stretched into a quad.
+_FACE_FAR_SIDES = (_CUBE_SIGNS > 0).reshape(6, 4, 3)
+_FACE_FAR_SIDES.flags.writeable = False
+
+
+@lru_cache(maxsize=None)
+def _cube_offsets(n: number) -> np.ndarray:
+    'Return the read-only offsets of the cube vertices from its center for size 2*n.'
+    offsets = _CUBE_SIGNS * np.float32(n)
+    offsets.flags.writeable = False
+    return offsets
+
+
+def boxes_in_frustum(planes: np.ndarray, lows: np.ndarray, highs: np.ndarray) -> np.ndarray:
+    """
+    Test many axis aligned boxes against a view frustum at once. A box counts
+    as inside unless it is entirely behind one of the planes, so a few boxes
+    near the corners of the frustum pass without being visible.
+
+    Parameters
+    ----------
+    planes : ndarray of shape (6, 4)
+        The planes from `frustum_planes()`.
+    lows, highs : ndarray of shape (N, 3)
+        The lowest and highest corner of each box.
+
+    Returns
+    -------
+    inside : bool ndarray of shape (N,)
+    """
+
+    normals = planes[:, :3]
+    # The corner of each box that is farthest along each plane normal.
+    corners = np.where(normals >= 0, highs[:, None, :], lows[:, None, :])
+    return ((corners * normals).sum(axis=2) + planes[:, 3] >= 0).all(axis=1)
+
+
+def cube_corners_into(x: number, y: number, z: number, n: number,
+                      out: np.ndarray) -> np.ndarray:
+    """
+    Write the 8 corners of the cube at position x, y, z with size 2*n into
+    `out`. Drawn indexed with CUBE_INDICES, they make the 6 faces of the
+    cube.
 
+    Parameters
+    ----------
+    x, y, z : int or float
+        The center of the cube.
+    n : int or float
+        Half of the cube size.
+    out : contiguous float32 ndarray of len 24
 
-def cube_vertices(x: number, y: number, z: number, n: number) -> list[number]:
-    'Return the vertices of the cube at position x, y, z with size 2*n.'
-    return [
-        x-n, y+n, z-n, x-n, y+n, z+n, x+n, y+n, z+n, x+n, y+n, z-n,  # top
-        x-n, y-n, z-n, x+n, y-n, z-n, x+n, y-n, z+n, x-n, y-n, z+n,  # bottom
-        x-n, y-n, z-n, x-n, y-n, z+n, x-n, y+n, z+n, x-n, y+n, z-n,  # left
-        x+n, y-n, z+n, x+n, y-n, z-n, x+n, y+n, z-n, x+n, y+n, z+n,  # right
-        x-n, y-n, z+n, x+n, y-n, z+n, x+n, y+n, z+n, x-n, y+n, z+n,  # front
-        x+n, y-n, z-n, x-n, y-n, z-n, x-n, y+n, z-n, x+n, y+n, z-n,  # back
-    ]
+    Returns
+    -------
+    out : the same ndarray, filled
+    """
+
+    np.multiply(_CUBE_CORNER_SIGNS, n, out=out.reshape(8, 3))
+    out.reshape(8, 3)[:] += (x, y, z)
+    return out
+
+
+def frustum_planes(matrix: np.ndarray) -> np.ndarray:
+    """
+    Extract the 6 clipping planes of the view frustum from the product of the
+    projection and modelview matrices.
+
+    Parameters
+    ----------
+    matrix : ndarray of shape (4, 4)
+        The matrix that maps world coordinates to clip coordinates.
+
+    Returns
+    -------
+    planes : ndarray of shape (6, 4)
+        The (a, b, c, d) of each plane, such that points inside the frustum
+        have a*x + b*y + c*z + d >= 0.
+    """
+
+    w = matrix[3]
+    return np.array([w + matrix[0], w - matrix[0], w + matrix[1],
+                     w - matrix[1], w + matrix[2], w - matrix[2]])
+
+
+def greedy_quads(faces: list[tuple[int]], tiles: list) -> tuple[list[tuple[int]], list]:
+    """
+    Merge adjacent block faces that point the same way, lie in the same plane
+    and have the same tile into rectangular quads.
+
+    Parameters
+    ----------
+    faces : list of tuple of len 4
+        The (x, y, z, face) of the block faces, face being an index in FACES.
+    tiles : list
+        The tile of each face. Faces are only merged with equal tiles.
+
+    Returns
+    -------
+    quads : list of tuple of len 6
+        The (x, y, z, face, width, height) of each quad, where x, y, z is the
+        block the quad starts from, and width and height are how many blocks
+        it spans along the u and v texture axes of the face.
+    tiles : list
+        The tile of each quad.
+    """
+
+    remaining = dict(zip(faces, tiles))
+    quads = []
+    quad_tiles = []
+    for key in sorted(remaining):
+        if key not in remaining:
+            continue
+        tile = remaining.pop(key)
+        x, y, z, face = key
+        (ux, uy, uz), (vx, vy, vz) = _FACE_UV_STEPS[face]
+
+        width = 1
+        while remaining.get(cell := (x + width * ux, y + width * uy, z + width * uz, face)) == tile:
+            del remaining[cell]
+            width += 1
+        height = 1
+        while True:
+            row = [(x + i * ux + height * vx, y + i * uy + height * vy,
+                    z + i * uz + height * vz, face) for i in range(width)]
+            if not all(remaining.get(cell) == tile for cell in row):
+                break
+            for cell in row:
+                del remaining[cell]
+            height += 1
+        quads.append((*key, width, height))
+        quad_tiles.append(tile)
+    return quads, quad_tiles
 
 
 def normalize(position: tuple[number]) -> tuple[int]:
@@ -34,7 +195,7 @@ def normalize(position: tuple[number]) -> tuple[int]:
     """
 
     x, y, z = position
-    return round(x), round(y), round(z)
+    return floor(x + 0.5), floor(y + 0.5), floor(z + 0.5)
 
 
 def sectorize(position: tuple[number]) -> tuple[int]:
@@ -50,20 +211,112 @@ def sectorize(position: tuple[number]) -> tuple[int]:
     sector : tuple of len 3
     """
 
-    x, _, z = normalize(position)
-    return x // CHUNK_SIZE, 0, z // CHUNK_SIZE
+    x, _, z = position
+    return floor(x + 0.5) >> CHUNK_SHIFT, 0, floor(z + 0.5) >> CHUNK_SHIFT
+
+
+def pack_textures(sizes: dict[str, tuple[int]]) -> tuple[int, dict[str, tuple[int]]]:
+    """
+    Pack rectangles of the given sizes into the smallest power-of-two square.
+    Rectangles are placed largest first in rows that alternate between left to
+    right and right to left, each one dropped onto the skyline of the rows
+    below it. Ties are broken by name, so the layout is the same every run.
+
+    Parameters
+    ----------
+    sizes : dict
+        Mapping from name to the (width, height) of each rectangle.
+
+    Returns
+    -------
+    size : int
+        The side length of the square.
+    offsets : dict
+        Mapping from name to the (x, y) of the bottom left corner of each
+        rectangle.
+    """
+
+    names = sorted(sizes, key=lambda name: (
+        -max(sizes[name]), -min(sizes[name]), name))
+    area = sum(w * h for w, h in sizes.values())
+    size = 1
+    while size * size < area or size < max(max(s) for s in sizes.values()):
+        size *= 2
+
+    while True:
+        skyline = np.zeros(size, dtype=np.int32)
+        offsets = {}
+        x, step = 0, 1
+        for name in names:
+            w, h = sizes[name]
+            # Skip past spots where the rectangle would stick out of the top,
+            # turning around at the edges; give up on this size once a whole
+            # row in both directions has been tried.
+            turns = 0
+            while True:
+                if not 0 <= x + w * step <= size:
+                    turns += 1
+                    x, step = (0, 1) if step < 0 else (size, -1)
+                x0 = x if step > 0 else x - w
+                y = int(skyline[x0:x0 + w].max())
+                if y + h <= size or turns > 2:
+                    break
+                x += w * step
+            if y + h > size:
+                break
+            skyline[x0:x0 + w] = y + h
+            offsets[name] = x0, y
+            x += w * step
+        else:
+            return size, offsets
+        size *= 2
 
 
-def tex_coord(x: int, y: int, n: int = 4) -> list[number]:
-    'Return the bounding vertices of the texture square.'
-    m = 1 / n
-    dx, dy = x * m, y * m
-    return dx, dy, dx + m, dy, dx + m, dy + m, dx, dy + m
+def quad_tex_coords_batch(quads: np.ndarray) -> np.ndarray:
+    """
+    Return the texture coordinates of quads from `greedy_quads()`, which
+    repeat the texture once per block the quad spans.
+
+    Parameters
+    ----------
+    quads : int ndarray of shape (N, 6)
+
+    Returns
+    -------
+    tex_coords : float32 ndarray of shape (N, 8)
+    """
+
+    return (_FACE_UVS * quads[:, None, 4:6]).astype(np.float32).reshape(len(quads), 8)
+
+
+def quad_vertices_batch(quads: np.ndarray, n: number) -> np.ndarray:
+    """
+    Return the vertices of quads from `greedy_quads()`.
+
+    Parameters
+    ----------
+    quads : int ndarray of shape (N, 6)
+    n : int or float
+        Half of the block size.
+
+    Returns
+    -------
+    vertices : float32 ndarray of shape (N, 12)
+    """
+
+    faces = quads[:, 3]
+    rows = np.arange(len(quads))
+    axes = _FACE_UV_AXES[faces]
+    # Number of blocks the far side is moved by along each axis.
+    stretch = np.zeros((len(quads), 3), dtype=np.float32)
+    stretch[rows, axes[:, 0]] = quads[:, 4] - 1
+    stretch[rows, axes[:, 1]] = quads[:, 5] - 1
+    vertices = np.add(quads[:, None, :3], _cube_offsets(n).reshape(6, 4, 3)[faces],
+                      dtype=np.float32)
+    vertices += _FACE_FAR_SIDES[faces] * stretch[:, None, :]
+    return vertices.reshape(len(quads), 12)
 
 
-def tex_coords(top: tuple[int], bottom: tuple[int], side: tuple[int]) -> list[list[number]]:
-    'Return a list of the texture squares for the top, bottom and side.'
-    top = tex_coord(*top)
-    bottom = tex_coord(*bottom)
-    side = tex_coord(*side)
-    return [top, bottom, side, side, side, side]
+def face_tiles(top: tuple[int], bottom: tuple[int], side: tuple[int]) -> tuple[tuple[int]]:
+    'Return a tuple of the tiles of each face for the top, bottom and side.'
+    return top, bottom, side, side, side, side
@@ -1,52 +1,124 @@
-from collections import deque
+from collections import Counter, deque
+from functools import lru_cache
 from logging import info
-from math import floor
 from time import perf_counter
 
-from perlin_noise import PerlinNoise
+import numpy as np
 from pyglet import image
 from pyglet.gl import *
-from pyglet.graphics import Batch, TextureGroup, VertextList
+from pyglet.graphics import Batch, TextureGroup
+from pyglet.graphics.vertexdomain import VertexList
 
+from blocks import BLOCK_IDS, World
 from constants import *
 from functions import *
+from noise import perlin_grid
 from utils import *
 
 
 __all__ = ['Model']
 
-BLOCKS: dict[str, list[list[number]]] = {
-    'dirt': tex_coords((0, 1), (0, 1), (0, 1)),
-    'grass_block': tex_coords((1, 0), (0, 1), (0, 0)),
-    'sand': tex_coords((1, 1), (1, 1), (1, 1)),
-    'bricks': tex_coords((2, 0), (2, 0), (2, 0)),
-    'bedrock': tex_coords((2, 1), (2, 1), (2, 1)),
+# Tiles of the texture sheet used by each face of the blocks.
+BLOCKS: dict[str, tuple[tuple[int]]] = {
+    'dirt': face_tiles((0, 1), (0, 1), (0, 1)),
+    'grass_block': face_tiles((1, 0), (0, 1), (0, 0)),
+    'sand': face_tiles((1, 1), (1, 1), (1, 1)),
+    'bricks': face_tiles((2, 0), (2, 0), (2, 0)),
+    'bedrock': face_tiles((2, 1), (2, 1), (2, 1)),
 }
+# The same tiles keyed by the block ids stored in the world.
+BLOCK_TILES: dict[int, tuple[tuple[int]]] = {
+    BLOCK_IDS[name]: tiles for name, tiles in BLOCKS.items()
+}
+
+
+# Offsets from the sector of the player to the sectors shown around it.
+SECTOR_PAD = 4
+SECTOR_OFFSETS: list[tuple[int]] = [
+    (dx, dy, dz)
+    for dx in range(-SECTOR_PAD, SECTOR_PAD + 1)
+    for dy in (0,)  # range(-SECTOR_PAD, SECTOR_PAD + 1)
+    for dz in range(-SECTOR_PAD, SECTOR_PAD + 1)
+    if dx ** 2 + dy ** 2 + dz ** 2 <= (SECTOR_PAD + 1) ** 2
+]
+
+
+@lru_cache(maxsize=16)
+def sectors_around(sector: tuple[int]) -> frozenset[tuple[int]]:
+    'Returns the sectors shown while the player is in `sector`.'
+    x, y, z = sector
+    return frozenset((x + dx, y + dy, z + dz) for dx, dy, dz in SECTOR_OFFSETS)
+
+
+def load_tiles(path: str, n: int = 4) -> dict[tuple[int], TextureGroup]:
+    """
+    Split the n x n texture sheet at `path` into one texture per tile. Merged
+    faces repeat their tile, which only works when it has its own texture.
+
+    Parameters
+    ----------
+    path : path of the texture sheet
+    n : number of tiles along each side of the sheet
+
+    Returns
+    -------
+    groups : mapping from the (x, y) of each tile to its texture group
+    """
+
+    sheet = image.load(path)
+    width, height = sheet.width // n, sheet.height // n
+    groups = {}
+    for x in range(n):
+        for y in range(n):
+            texture = sheet.get_region(x * width, y * height, width, height).get_texture()
+            glBindTexture(texture.target, texture.id)
+            glTexParameteri(texture.target, GL_TEXTURE_WRAP_S, GL_REPEAT)
+            glTexParameteri(texture.target, GL_TEXTURE_WRAP_T, GL_REPEAT)
+            glTexParameteri(texture.target, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(texture.target, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            groups[x, y] = TextureGroup(texture)
+    return groups
 
 
 class Model(object):
     def __init__(self):
-        # A Batch is a collection of vertex lists for batched rendering.
+        # A Batch is a collection of vertex lists for batched rendering. The
+        # vertex lists are drawn one by one, so sectors out of view can be
+        # skipped.
         self.batch: Batch = Batch()
 
-        # A TextureGroup manages an OpenGL texture.
-        self.group: TextureGroup = TextureGroup(image.load(TEXTURE_PATH).get_texture())
+        # A TextureGroup manages an OpenGL texture. There is one for each
+        # tile of the texture sheet.
+        self.groups: dict[tuple[int], TextureGroup] = load_tiles(TEXTURE_PATH)
 
         # A mapping from position to the name of the block at that position.
-        # This defines all the blocks that are currently in the world.
-        self.world: dict[tuple[int], str] = {}
+        # This defines all the blocks that are currently in the world, stored
+        # as one chunk of block ids per sector.
+        self.world: World = World()
+
+        # Incremented whenever a block is added or removed, so that anything
+        # derived from the world can tell when it is out of date.
+        self.version: int = 0
+
+        # Mapping from shown sector to the (x, y, z, face) of the exposed
+        # block faces that make up its mesh, face being an index in FACES.
+        # The list stays empty until the mesh is built.
+        self.shown: dict[tuple[int], list[tuple[int]]] = {}
 
-        # Same mapping as `world` but only contains blocks that are shown.
-        self.shown: dict[tuple[int], list[list[int]]] = {}
+        # Mapping from sector to the pyglet `VertexList`s holding its mesh,
+        # keyed by the tile each of them uses.
+        self._shown: dict[tuple[int], dict[tuple[int], VertexList]] = {}
 
-        # Mapping from position to a pyglet `VertextList` for all shown blocks.
-        self._shown: dict[tuple[int], VertextList] = {}
+        # Mapping from sector to the lowest and highest corner of its mesh.
+        self.bounds: dict[tuple[int], tuple[np.ndarray]] = {}
 
-        # Mapping from sector to a list of positions inside that sector.
-        self.sectors: dict[tuple[int], list[tuple[int]]] = {}
+        # The planes of the view frustum of the last draw, and the vertex
+        # lists that were inside it by texture group, until a mesh changes.
+        self.planes: None | np.ndarray = None
+        self.visible: None | list[tuple[TextureGroup, list[VertexList]]] = None
 
         # Simple function queue implementation. The queue is populated with
-        # _show_block() and _hide_block() calls
+        # _show_sector() and _hide_sector() calls
         self.queue: deque = deque()
 
         self.generate_terrain()
@@ -56,23 +128,15 @@ class Model(object):
 
         info('Generating world terrain...')
 
-        noise1 = PerlinNoise(octaves=7, seed=WORLD_SEED)
-        noise2 = PerlinNoise(octaves=9, seed=WORLD_SEED + 1)
-        noise3 = PerlinNoise(octaves=10, seed=WORLD_SEED + 2)
-
         n = 64  # 1 / 2 width and height of world
-        for x in range(-n, n + 1):
-            for z in range(-n, n + 1):
-                y = 15
-                y += noise1((x / 150, z / 150)) * 8
-                y += noise2((x / 700, z / 700)) * 15
-                y += noise3((x / 2000, z / 32000)) * 30
-                y = floor(y)
-
-                self.add_block((x, 0, z), 'bedrock', immediate=False)
-                for _y in range(1, y):
-                    self.add_block((x, _y, z), 'dirt', immediate=False)
-                self.add_block((x, y, z), 'grass_block', immediate=False)
+        coords = np.arange(-n, n + 1)
+        heights = np.full((coords.size, coords.size), 15.0)
+        heights += perlin_grid(coords / 150, coords / 150, 7, WORLD_SEED) * 8
+        heights += perlin_grid(coords / 700, coords / 700, 9, WORLD_SEED + 1) * 15
+        heights += perlin_grid(coords / 2000, coords / 32000, 10, WORLD_SEED + 2) * 30
+        heights = np.floor(heights).astype(int)
+
+        self.world.fill_columns(-n, -n, heights, 'bedrock', 'dirt', 'grass_block')
 
         info('Generated world terrain!')
 
@@ -93,17 +157,7 @@ class Model(object):
             How many blocks away to search for a hit.
         """
 
-        m = 8
-        x, y, z = position
-        dx, dy, dz = vector
-        previous = None
-        for _ in range(max_distance * m):
-            key = normalize((x, y, z))
-            if key != previous and key in self.world:
-                return key, previous
-            previous = key
-            x, y, z = x + dx / m, y + dy / m, z + dz / m
-        return None, None
+        return self.world.raycast(position, vector, max_distance)
 
     def exposed(self, position: tuple[int]) -> bool:
         """
@@ -111,15 +165,12 @@ class Model(object):
         blocks, True otherwise.
         """
 
-        x, y, z = position
-        for dx, dy, dz in FACES:
-            if (x + dx, y + dy, z + dz) not in self.world:
-                return True
-        return False
+        return self.world.exposed(position)
 
     def add_block(self, position: tuple[int], name: str, immediate: bool = True):
         """
         Add a block with the given `name` and `position` to the world.
+        Blocks outside of the world height are ignored.
 
         Parameters
         ----------
@@ -128,16 +179,15 @@ class Model(object):
         name : string
             ID of the block.
         immediate : bool
-            Whether or not to draw the block immediately.
+            Whether or not to draw the block immediately. Otherwise it is
+            only drawn once its sector is shown again.
         """
 
-        if position in self.world:
-            self.remove_block(position, immediate)
+        if not 0 <= position[1] < WORLD_HEIGHT:
+            return
         self.world[position] = name
-        self.sectors.setdefault(sectorize(position), []).append(position)
+        self.version += 1
         if immediate:
-            if self.exposed(position):
-                self.show_block(position)
             self.check_neighbors(position)
 
     def remove_block(self, position: tuple[int], immediate: bool = True):
@@ -153,117 +203,152 @@ class Model(object):
         """
 
         del self.world[position]
-        self.sectors[sectorize(position)].remove(position)
+        self.version += 1
         if immediate:
-            if position in self.shown:
-                self.hide_block(position)
             self.check_neighbors(position)
 
     def check_neighbors(self, position: tuple[int]):
         """
-        Check all blocks surrounding `position` and ensure their visual
-        state is current. This means hiding blocks that are not exposed and
-        ensuring that all exposed blocks are shown. Usually used after a block
-        is added or removed.
+        Rebuild the mesh of every shown sector containing `position` or one
+        of its neighbors, so that their visual state is current. Usually used
+        after a block is added or removed.
         """
 
-        x, y, z = position
-        for dx, dy, dz in FACES:
-            key = (x + dx, y + dy, z + dz)
-            if key not in self.world:
-                continue
-            if self.exposed(key):
-                if key not in self.shown:
-                    self.show_block(key)
-            else:
-                if key in self.shown:
-                    self.hide_block(key)
-
-    def show_block(self, position: tuple[int], immediate: bool = True):
+        # Only the horizontal neighbors can be in another sector, and most of
+        # the time they are all in the sector of the block itself.
+        x, _, z = position
+        sectors = {(x + dx >> CHUNK_SHIFT, 0, z + dz >> CHUNK_SHIFT) for dx, _, dz in FACES}
+        for sector in sectors & self.shown.keys():
+            self.show_sector(sector)
+
+    def show_sector(self, sector: tuple[int], immediate: bool = True):
         """
-        Show the block at the given `position`. This method assumes the
-        block has already been added with add_block()
+        Ensure all block faces in the given sector that should be shown are
+        drawn to the canvas, as a single mesh. Only faces that are not
+        covered by a neighboring block are drawn, and neighboring faces with
+        the same tile are merged into larger quads.
 
         Parameters
         ----------
-        position : tuple of len 3
-            The (x, y, z) position of the block to show.
+        sector : tuple of len 3
+            The sector to show.
         immediate : bool
-            Whether or not to show the block immediately.
+            Whether or not to build the mesh immediately.
         """
 
-        name = self.world[position]
-        coords = BLOCKS[name]
-        self.shown[position] = coords
+        # The faces are only looked up when the mesh is built, so that
+        # queued sectors cost nothing until their turn. Until then the list
+        # is empty, and it tells queued builds apart from later ones.
+        faces = self.shown[sector] = []
         if immediate:
-            self._show_block(position, coords)
+            self._show_sector(sector, faces)
         else:
-            self._enqueue(self._show_block, position, coords)
+            self._enqueue(self._show_sector, sector, faces)
 
-    def _show_block(self, position: tuple[int], coords: list[list[number]]):
+    def _show_sector(self, sector: tuple[int], faces: list[tuple[int]]):
         """
-        Private implementation of the `show_block()` method.
+        Private implementation of the `show_sector()` method.
 
         Parameters
         ----------
-        position : tuple of len 3
-            The (x, y, z) position of the block to show.
-        coords : list of len 3
-            The coordinates of the coords squares. Use `tex_coords()` to
-            generate.
+        sector : tuple of len 3
+            The sector to show.
+        faces : list
+            The list of the sector in `shown`, which is filled with the
+            (x, y, z, face) of the block faces to draw.
         """
 
-        x, y, z = position
-        vertex_data = cube_vertices(x, y, z, 0.5)
-        coords_data = sum(coords, start=())
-        # create vertex list
-        # FIXME Maybe `add_indexed()` should be used instead
-        self._shown[position] = self.batch.add(24, GL_QUADS, self.group,
-            ('v3f/static', vertex_data),
-            ('t2f/static', coords_data))
-
-    def hide_block(self, position: tuple[int], immediate: bool = True):
+        if self.shown.get(sector) is not faces:
+            # The sector was shown again or hidden since this was queued.
+            return
+        found, ids = self.world.exposed_faces(sector)
+        tiles = [BLOCK_TILES[block][face]
+                 for block, face in zip(ids.tolist(), found[:, 3].tolist())]
+        faces.extend(map(tuple, found.tolist()))
+        self._hide_sector(sector)
+        if not faces:
+            return
+        quads, tiles = greedy_quads(faces, tiles)
+        # Sorted by tile, the data of each vertex list is one flat slice of
+        # the data of the whole sector.
+        order = sorted(range(len(tiles)), key=tiles.__getitem__)
+        quads = np.array(quads)[order]
+        vertex_data = quad_vertices_batch(quads, 0.5).ravel()
+        coords_data = quad_tex_coords_batch(quads).ravel()
+        self._shown[sector] = vertex_lists = {}
+        start = 0
+        for tile, count in sorted(Counter(tiles).items()):
+            stop = start + count
+            vertex_list = vertex_lists[tile] = self.batch.add(4 * count, GL_QUADS, self.groups[tile],
+                                    'v3f/dynamic', 't2f/dynamic')
+            # pyglet copies initial data one item at a time, so the arrays
+            # are copied in through NumPy views of the vertex list instead.
+            # Static attributes are interleaved in one buffer, the others
+            # each get a contiguous one that can be viewed that way.
+            np.ctypeslib.as_array(vertex_list.vertices)[:] = vertex_data[12 * start:12 * stop]
+            np.ctypeslib.as_array(vertex_list.tex_coords)[:] = coords_data[8 * start:8 * stop]
+            start = stop
+        vertices = vertex_data.reshape(-1, 3)
+        self.bounds[sector] = vertices.min(axis=0), vertices.max(axis=0)
+
+    def hide_sector(self, sector: tuple[int], immediate: bool = True):
         """
-        Hide the block at the given `position`. Hiding does not remove the
-        block from the world.
+        Ensure the mesh of the given sector is removed from the canvas.
+        Hiding does not remove the blocks from the world.
 
         Parameters
         ----------
-        position : tuple of len 3
-            The (x, y, z) position of the block to hide.
+        sector : tuple of len 3
+            The sector to hide.
         immediate : bool
-            Whether or not to immediately remove the block from the canvas.
+            Whether or not to immediately remove the mesh from the canvas.
         """
 
-        self.shown.pop(position)
+        self.shown.pop(sector, None)
         if immediate:
-            self._hide_block(position)
+            self._hide_sector(sector)
         else:
-            self._enqueue(self._hide_block, position)
+            self._enqueue(self._hide_sector, sector)
 
-    def _hide_block(self, position: tuple[int]):
-        "Private implementation of the 'hide_block()` method."
-        self._shown.pop(position).delete()
+    def _hide_sector(self, sector: tuple[int]):
+        "Private implementation of the `hide_sector()` method."
+        for vertex_list in self._shown.pop(sector, {}).values():
+            vertex_list.delete()
+        self.bounds.pop(sector, None)
+        self.visible = None
 
-    def show_sector(self, sector: tuple[int]):
+    def draw(self, planes: np.ndarray):
         """
-        Ensure all blocks in the given sector that should be shown are
-        drawn to the canvas.
-        """
-
-        for position in self.sectors.get(sector, []):
-            if position not in self.shown and self.exposed(position):
-                self.show_block(position, False)
+        Draw the shown sectors whose mesh is at least partly inside the view
+        frustum.
 
-    def hide_sector(self, sector: tuple[int]):
-        """
-        Ensure all blocks in the given sector that should be hidden are
-        removed from the canvas.
+        Parameters
+        ----------
+        planes : ndarray of shape (6, 4)
+            The planes of the view frustum, see `frustum_planes()`. Passing
+            the same array again reuses the sectors found inside it.
         """
 
-        for position in self.sectors.get(sector, []):
-            if position in self.shown:
-                self.hide_block(position, False)
+        if planes is not self.planes or self.visible is None:
+            # The same planes are passed again as long as the camera stands
+            # still, and then so are the vertex lists inside them.
+            self.planes = planes
+            by_tile = {}
+            if self.bounds:
+                lows, highs = map(np.array, zip(*self.bounds.values()))
+                inside = boxes_in_frustum(planes, lows, highs).tolist()
+                for sector, visible in zip(self.bounds, inside):
+                    if visible:
+                        for tile, vertex_list in self._shown[sector].items():
+                            by_tile.setdefault(tile, []).append(vertex_list)
+            self.visible = [(self.groups[tile], vertex_lists)
+                            for tile, vertex_lists in by_tile.items()]
+        # Each texture is bound once for all the sectors that use it.
+        for group, vertex_lists in self.visible:
+            group.set_state()
+            for vertex_list in vertex_lists:
+                vertex_list.draw(GL_QUADS)
+            group.unset_state()
 
     def change_sectors(self, before: tuple[int], after: tuple[int]):
         """
@@ -272,49 +357,53 @@ class Model(object):
         world rendering.
         """
 
-        before_set = set()
-        after_set = set()
-        pad = 4
-        for dx in range(-pad, pad + 1):
-            for dy in (0,):  # range(-pad, pad + 1):
-                for dz in range(-pad, pad + 1):
-                    if dx ** 2 + dy ** 2 + dz ** 2 > (pad + 1) ** 2:
-                        continue
-                    if before:
-                        x, y, z = before
-                        before_set.add((x + dx, y + dy, z + dz))
-                    if after:
-                        x, y, z = after
-                        after_set.add((x + dx, y + dy, z + dz))
-        show = after_set - before_set
+        # The sectors around the sector left were computed when it was
+        # entered, so only the sector entered can miss the cache.
+        before_set = sectors_around(before) if before else frozenset()
+        after_set = sectors_around(after) if after else frozenset()
+        show = list(after_set - before_set)
         hide = before_set - after_set
+        if show and self.planes is not None:
+            # Queue the sectors in view first, so that they are built before
+            # the ones behind the player.
+            lows = np.array(show, dtype=float) * CHUNK_SIZE - 0.5
+            lows[:, 1] = -0.5
+            highs = lows + CHUNK_SIZE
+            highs[:, 1] = WORLD_HEIGHT - 0.5
+            inside = boxes_in_frustum(self.planes, lows, highs)
+            show = [show[i] for i in np.argsort(~inside, kind='stable').tolist()]
         for sector in show:
-            self.show_sector(sector)
+            self.show_sector(sector, False)
         for sector in hide:
-            self.hide_sector(sector)
+            self.hide_sector(sector, False)
+        if after:
+            # Keep the chunks that shown sectors and their borders are built
+            # from, with some slack so walking back and forth doesn't repack.
+            self.world.pack_far(after, SECTOR_PAD + 2)
 
     def _enqueue(self, func, *args):
         'Add `func` to the internal queue.'
         self.queue.append((func, args))
 
-    def _dequeue(self):
-        'Pop the top function from the internal queue and call it.'
-        func, args = self.queue.popleft()
-        func(*args)
-
     def process_queue(self):
         """
         Process the entire queue while taking periodic breaks. This allows
         the game loop to run smoothly. The queue contains calls to
-        _show_block() and _hide_block() so this method should be called if
-        add_block() or remove_block() was called with immediate=False
+        _show_sector() and _hide_sector() so this method should be called if
+        show_sector() or hide_sector() was called with immediate=False
         """
 
-        start = perf_counter()
-        while self.queue and perf_counter() - start < 1 / TICKS_PER_SEC:
-            self._dequeue()
+        # Every call builds or frees a whole sector, which takes much longer
+        # than reading the clock, so the deadline is checked after each one.
+        deadline = perf_counter() + 1 / TICKS_PER_SEC
+        queue = self.queue
+        while queue and perf_counter() < deadline:
+            func, args = queue.popleft()
+            func(*args)
 
     def process_entire_queue(self):
         'Process the entire queue without breaks.'
-        while self.queue:
-            self._dequeue()
\ No newline at end of file
+        queue = self.queue
+        while queue:
+            func, args = queue.popleft()
+            func(*args)
\ No newline at end of file
@@ -0,0 +1,80 @@
+from random import Random
+
+import numpy as np
+
+
+__all__ = ['perlin_grid']
+
+
+def _fade(t: np.ndarray) -> np.ndarray:
+    'Smooth [0, 1] values with the quintic fade curve.'
+    return 6 * t ** 5 - 15 * t ** 4 + 10 * t ** 3
+
+
+def _gradients(xs: range, zs: range, seed: int) -> np.ndarray:
+    'Return the random gradient vector of every lattice point in `xs` by `zs`.'
+    # One generator is seeded again for every point rather than created.
+    rng = Random()
+    reseed, uniform = rng.seed, rng.uniform
+    gradients = []
+    for x in xs:
+        for z in zs:
+            # Same seeding as `perlin_noise.RandVec`, so that worlds stay the
+            # same for a given seed.
+            reseed(seed * max(1, abs(x + 10 * z + 1)))
+            gradients.append((uniform(-1, 1), uniform(-1, 1)))
+    return np.array(gradients).reshape(len(xs), len(zs), 2)
+
+
+def perlin_grid(xs: np.ndarray, zs: np.ndarray, octaves: int, seed: int) -> np.ndarray:
+    """
+    Sample 2D Perlin noise on every point of the grid spanned by `xs` and
+    `zs` at once. This gives the same values as calling
+    `perlin_noise.PerlinNoise(octaves, seed)` on each point.
+
+    Parameters
+    ----------
+    xs : 1D array of the x coordinates to sample
+    zs : 1D array of the z coordinates to sample
+    octaves : number of lattice cells in each [0, 1] range
+    seed : positive seed of the noise
+
+    Returns
+    -------
+    noise : ndarray of shape (len(xs), len(zs))
+    """
+
+    x = np.asarray(xs, dtype=np.float64) * octaves
+    z = np.asarray(zs, dtype=np.float64) * octaves
+    x0 = np.floor(x).astype(np.int64)
+    z0 = np.floor(z).astype(np.int64)
+    x_min, z_min = int(x0.min()), int(z0.min())
+    gradients = _gradients(range(x_min, int(x0.max()) + 2),
+                           range(z_min, int(z0.max()) + 2), seed)
+    gradients_x = np.ascontiguousarray(gradients[..., 0])
+    gradients_z = np.ascontiguousarray(gradients[..., 1])
+
+    # Everything that only depends on one axis is computed once per row or
+    # column, leaving only the gradient lookups and products to the grid,
+    # which are done in place in two reused buffers.
+    noise = np.zeros((len(x), len(z)))
+    dot = np.empty_like(noise)
+    term = np.empty_like(noise)
+    for cx in (x0, x0 + 1):
+        dx = x - cx
+        weight_x = _fade(1 - abs(dx))[:, None]
+        dx = dx[:, None]
+        rows = cx - x_min
+        for cz in (z0, z0 + 1):
+            dz = z - cz
+            columns = cz - z_min
+            # Gather the few lattice rows along z first, then copy whole rows.
+            np.take(gradients_x[:, columns], rows, axis=0, out=dot)
+            dot *= dx
+            np.take(gradients_z[:, columns], rows, axis=0, out=term)
+            term *= dz
+            dot += term
+            np.multiply(weight_x, _fade(1 - abs(dz)), out=term)
+            term *= dot
+            noise += term
+    return noise
@@ -1 +1,32 @@
+from collections.abc import Callable
+from typing import Any
+
+
+__all__ = ['LazyDict', 'number']
+
 number = int | float
+
+
+class LazyDict(dict):
+    """
+    Dictionary whose values are only loaded when they are first looked up.
+    `sources` maps every key that can be loaded to where it is loaded from,
+    and `load(self, key)` has to store the value of `key` in the dictionary.
+    """
+
+    def __init__(self, load: Callable[['LazyDict', Any], None]):
+        super().__init__()
+        self.load = load
+        self.sources: dict = {}
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.sources or super().__contains__(key)
+
+    def __missing__(self, key: Any) -> Any:
+        if key not in self.sources:
+            raise KeyError(key)
+        self.load(self, key)
+        return super().__getitem__(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self[key] if key in self else default
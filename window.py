@@ -1,22 +1,24 @@
-from math import atan2, cos, degrees, floor, radians, sin, sqrt
+from math import ceil, cos, floor, hypot, pi, sin, sqrt
 from sys import version_info
 
+import numpy as np
 import pyglet
 from pyglet import clock, graphics
+from pyglet.graphics import Batch
+from pyglet.graphics.vertexdomain import VertexList
 from pyglet.gl import *
 from pyglet.shapes import Rectangle
 from pyglet.text import Label
-from pyglet.window import Window as PygletWindow, VertextList, key, mouse
+from pyglet.window import Window as PygletWindow, key, mouse
 
 from constants import *
 from functions import *
 from model import Model
 from utils import *
 
-
-keyboard = key.KeyStateHandler()
-
 JUMP_SPEED = sqrt(2 * GRAVITY * MAX_JUMP_HEIGHT)
+# The same factor `math.radians` multiplies by.
+DEG2RAD = pi / 180
 
 
 class Window(PygletWindow):
@@ -40,6 +42,10 @@ class Window(PygletWindow):
         # right, and 0 otherwise.
         self.strafe: list[number] = [0, 0]
 
+        # 1 while space is held, -1 while shift is held, and 0 for both or
+        # neither. The player climbs or sinks by it while flying.
+        self.climb: int = 0
+
         # First element is rotation of the player in the x-z plane (ground
         # plane) measured from the z-axis down. The second is the rotation
         # angle from the ground plane up. Rotation is in degrees.
@@ -48,11 +54,28 @@ class Window(PygletWindow):
         # 90 (looking straight up). The horizontal rotation range is unbounded.
         self.rotation: tuple[number] = (0, 0)
 
-        # Which sector the player is currently in.
+        # The horizontal motion for the last strafe and rotation, which stay
+        # the same over many updates.
+        self.motion_key: None | tuple = None
+        self.motion_xz: tuple[number] = (0, 0)
+
+        # Which sector the player is currently in, and the x and z ranges of
+        # positions inside it as (min x, max x, min z, max z).
         self.sector: None | tuple[int] = None
+        self.sector_bounds: tuple[number] = (0, 0, 0, 0)
 
         # The crosshairs at the center of the screen.
-        self.reticle: None | VertextList = None
+        self.reticle: None | VertexList = None
+
+        # The block under the crosshairs, and the (position, rotation, world
+        # version) it was found for.
+        self.focused: None | tuple[int] = None
+        self.focus_key: None | tuple[tuple[number]] = None
+
+        # The outline of the focused block, as the 8 corners of a cube. The
+        # same vertex list is moved around whenever the focus changes.
+        self.focus_outline: VertexList = pyglet.graphics.vertex_list_indexed(
+            8, CUBE_INDICES, 'v3f/dynamic')
 
         # Velocity in the y (upward) direction.
         self.dy: number = 0
@@ -63,22 +86,26 @@ class Window(PygletWindow):
         # The current block the user can place. Hit num keys to cycle.
         self.block: str = self.inventory[0]
 
-        # Convenience list of num keys.
-        self.num_keys: list[int] = [
-            key._1, key._2, key._3, key._4, key._5,
-            key._6, key._7, key._8, key._9, key._0]
+        # The strafe axis and direction each movement key adds while held.
+        self.strafe_keys: dict[int, tuple[int]] = {
+            key.W: (0, -1), key.S: (0, 1), key.A: (1, -1), key.D: (1, 1)}
+
+        # The offset of each num key from key 1, which cycles the inventory.
+        self.num_keys: dict[int, int] = {
+            symbol: symbol - key._1 for symbol in (
+                key._1, key._2, key._3, key._4, key._5,
+                key._6, key._7, key._8, key._9, key._0)}
 
         # Instance of the model that handles the world.
         self.model: Model = Model()
 
-        spawny = 1
-        self.position: tuple[number] = (0, 1, 0)
-        while self.position in self.model.world:
-            self.position = (0, spawny, 0)
-            spawny += 1
+        # The player spawns one block above the highest block at the origin.
+        spawny = self.model.world.column_top(0, 0) + 1
         self.position: tuple[number] = (0, spawny, 0)
 
-        # Debug screen labels.
+        # Debug screen labels. They share one batch, so all of them are drawn
+        # with a single bind of the font texture.
+        self.label_batch: Batch = Batch()
         self.left_labels: list[Label] = []
         self.left_label_size: int = 7
         self.left_label_bg: list[Rectangle] = []
@@ -89,7 +116,7 @@ class Window(PygletWindow):
                     '', font_name='Arial', font_size=self.height * 0.02,
                     bold=True, x=self.width * 0.03, y=y,
                     anchor_x='left', anchor_y='top',
-                    color=(255, 255, 255, 255)))
+                    color=(255, 255, 255, 255), batch=self.label_batch))
             self.left_label_bg.append(
                 Rectangle(
                     x=self.width * 0.025, y=y - self.height * 0.035,
@@ -108,7 +135,7 @@ class Window(PygletWindow):
                     '', font_name='Arial', font_size=self.height * 0.02,
                     bold=True, x=self.width * 0.97, y=y,
                     anchor_x='right', anchor_y='top',
-                    color=(255, 255, 255, 255)))
+                    color=(255, 255, 255, 255), batch=self.label_batch))
             self.right_label_bg.append(
                 Rectangle(
                     x=self.width * 0.975, y=y - self.height * 0.035,
@@ -117,35 +144,55 @@ class Window(PygletWindow):
             self.right_label_bg[i].opacity = 40
             y -= self.height * 0.03
 
+        # The planes of the view frustum, and the (position, rotation, size)
+        # of the window they were computed for.
+        self.frustum: None | np.ndarray = None
+        self.frustum_key: None | tuple = None
+
+        # The fps, position and rotation the debug labels were last updated
+        # for. Their text is only rebuilt when one of these changes.
+        self.label_values: None | tuple = None
+
         # This call schedules the `update()` method to be called
         # TICKS_PER_SEC. This is the main game event loop.
         clock.schedule_interval(self.update, 1 / TICKS_PER_SEC)
 
-        self.push_handlers(keyboard)
-
     def set_exclusive_mouse(self, exclusive: bool):
         """
         If `exclusive` is True, the game will capture the mouse, if False
         the game will ignore the mouse.
         """
 
-        super(Window, self).set_exclusive_mouse(exclusive)
-        self.exclusive = exclusive
+        if exclusive != self.exclusive:
+            super(Window, self).set_exclusive_mouse(exclusive)
+            self.exclusive = exclusive
+
+    @property
+    def rotation(self) -> tuple[number]:
+        'The (horizontal, vertical) rotation of the player in degrees.'
+        return self._rotation
+
+    @rotation.setter
+    def rotation(self, rotation: tuple[number]):
+        self._rotation = rotation
+        # The cosine and sine of the horizontal and of the vertical rotation,
+        # computed once here instead of every time they are needed.
+        x, y = rotation[0] * DEG2RAD, rotation[1] * DEG2RAD
+        cos_x, sin_x, cos_y, sin_y = self.rotation_trig = cos(x), sin(x), cos(y), sin(y)
+        # y ranges from -90 to 90, or -pi/2 to pi/2, so cos_y ranges from 0 to
+        # 1 and is 1 when looking ahead parallel to the ground and 0 when
+        # looking straight up or down. sin_y ranges from -1 to 1 and is -1
+        # when looking straight down and 1 when looking straight up.
+        # cos(x - 90) is sin(x) and sin(x - 90) is -cos(x).
+        self.sight_vector: tuple[number] = sin_x * cos_y, sin_y, -cos_x * cos_y
 
     def get_sight_vector(self) -> tuple[number]:
         """
         Returns the current line of sight vector indicating the direction
-        the player is looking.
+        the player is looking. It is computed when the rotation changes.
         """
 
-        x, y = self.rotation
-        # y ranges from -90 to 90, or -pi/2 to pi/2, so m ranges from 0 to 1 and
-        # is 1 when looking ahead parallel to the ground and 0 when looking
-        # straight up or down.
-        m = cos(radians(y))
-        # dy ranges from -1 to 1 and is -1 when looking straight down and 1 when
-        # looking straight up.
-        return cos(radians(x - 90)) * m, sin(radians(y)), sin(radians(x - 90)) * m
+        return self.sight_vector
 
     def get_motion_vector(self) -> tuple[number]:
         """
@@ -158,33 +205,33 @@ class Window(PygletWindow):
             Tuple containing the velocity in x, y, and z respectively.
         """
 
-        if any(self.strafe):
-            x_rotation, _ = self.rotation
-            strafe = degrees(atan2(*self.strafe))
-            x_angle = radians(x_rotation + strafe)
-            if self.flying:
-                dx = cos(x_angle)
-                dy = 0
-                if keyboard[key.SPACE]:
-                    dy += FLYING_Y_SPEED
-                if keyboard[key.LSHIFT]:
-                    dy -= FLYING_Y_SPEED
-                dz = sin(x_angle)
-            else:
-                dx = cos(x_angle)
-                dy = 0
-                dz = sin(x_angle)
-        else:
-            dy = 0
-            dx = 0
-            dz = 0
-            if self.flying:
-                if keyboard[key.SPACE]:
-                    dy += FLYING_Y_SPEED
-                if keyboard[key.LSHIFT]:
-                    dy -= FLYING_Y_SPEED
+        values = *self.strafe, self.rotation
+        if values != self.motion_key:
+            dx = dz = 0
+            if any(self.strafe):
+                # Turn the strafe direction, at angle atan2(*self.strafe), by
+                # the horizontal rotation, using the cached trig of the
+                # rotation.
+                cos_x, sin_x, _, _ = self.rotation_trig
+                sin_strafe, cos_strafe = self.strafe
+                length = hypot(sin_strafe, cos_strafe)
+                sin_strafe, cos_strafe = sin_strafe / length, cos_strafe / length
+                dx = cos_x * cos_strafe - sin_x * sin_strafe
+                dz = sin_x * cos_strafe + cos_x * sin_strafe
+            self.motion_key, self.motion_xz = values, (dx, dz)
+        dx, dz = self.motion_xz
+        dy = FLYING_Y_SPEED * self.climb if self.flying else 0
         return dx, dy, dz
 
+    def get_speed(self) -> number:
+        'Returns the speed the player moves at, in blocks per second.'
+        if self.sneaking:
+            return SNEAKING_SPEED
+        elif self.sprinting:
+            return FLYING_SPRINT_SPEED if self.flying else SPRINTING_SPEED
+        else:
+            return FLYING_SPEED if self.flying else WALKING_SPEED
+
     def update(self, dt: number):
         """
         This method is scheduled to be called repeatedly by the pyglet
@@ -197,14 +244,36 @@ class Window(PygletWindow):
         """
 
         self.model.process_queue()
-        sector = sectorize(self.position)
-        if sector != self.sector:
-            self.model.change_sectors(self.sector, sector)
-            if self.sector is None:
-                self.model.process_entire_queue()
-            self.sector = sector
-        m = 8  # TODO: increase this
+        # The sector only has to be found again once the player leaves it.
+        x, _, z = self.position
+        x_min, x_max, z_min, z_max = self.sector_bounds
+        if not (x_min <= x < x_max and z_min <= z < z_max):
+            sector = sectorize(self.position)
+            if sector != self.sector:
+                self.model.change_sectors(self.sector, sector)
+                if self.sector is None:
+                    self.model.process_entire_queue()
+                self.sector = sector
+            # Positions are rounded to blocks by `sectorize`.
+            x_min = (sector[0] << CHUNK_SHIFT) - 0.5
+            z_min = (sector[2] << CHUNK_SHIFT) - 0.5
+            self.sector_bounds = (x_min, x_min + CHUNK_SIZE,
+                                  z_min, z_min + CHUNK_SIZE)
         dt = min(dt, 0.2)
+        # `collide` only looks at the blocks next to the one the player is
+        # in, so no substep may carry the player more than 0.5 - pad (0.3)
+        # blocks, or a block could be skipped. Falling and jumping still take
+        # at least 8 substeps, so that jumps keep the same height. Otherwise
+        # the player moves in a straight line, which takes a single substep
+        # while standing still or walking.
+        dx, dy, dz = self.get_motion_vector()
+        distance = hypot(dx, dy, dz) * self.get_speed() * dt
+        m = 1
+        if not self.flying:
+            distance += (abs(self.dy) + GRAVITY * dt) * dt
+            if self.dy:
+                m = 8  # TODO: increase this
+        m = max(ceil(distance / 0.25), m)
         for _ in range(m):
             self._update(dt / m)
 
@@ -220,15 +289,7 @@ class Window(PygletWindow):
         """
 
         # moving
-        if self.sneaking:
-            speed = SNEAKING_SPEED
-        else:
-            if self.sprinting:
-                speed = FLYING_SPRINT_SPEED if self.flying else SPRINTING_SPEED
-            else:
-                speed = FLYING_SPEED if self.flying else WALKING_SPEED
-
-        d = dt * speed # distance covered this tick.
+        d = dt * self.get_speed() # distance covered this tick.
         dx, dy, dz = self.get_motion_vector()
         # New position in space, before accounting for gravity.
         dx, dy, dz = dx * d, dy * d, dz * d
@@ -242,8 +303,7 @@ class Window(PygletWindow):
             dy += self.dy * dt
         # collisions
         x, y, z = self.position
-        x, y, z = self.collide((x + dx, y + dy, z + dz), PLAYER_HEIGHT)
-        self.position = (x, y, z)
+        self.position = self.collide((x + dx, y + dy, z + dz), PLAYER_HEIGHT)
 
     def collide(self, position: tuple[number], height: number) -> tuple[number]:
         """
@@ -268,29 +328,12 @@ class Window(PygletWindow):
         # a collision. If .49, you sink into the ground, as if walking through
         # tall grass. If >= .5, you'll fall through the ground.
         pad = 0.2
-        p = list(position)
-        np = normalize(position)
-        for face in FACES:  # check all surrounding blocks
-            for i in range(3):  # check each dimension independently
-                if not face[i]:
-                    continue
-                # How much overlap you have with this dimension.
-                d = (p[i] - np[i]) * face[i]
-                if d < pad:
-                    continue
-                for dy in range(floor(height)):  # check each height
-                    op = list(np)
-                    op[1] -= dy
-                    op[i] += face[i]
-                    if tuple(op) not in self.model.world:
-                        continue
-                    p[i] -= (d - pad) * face[i]
-                    if face == (0, -1, 0) or face == (0, 1, 0):
-                        # You are colliding with the ground or ceiling, so stop
-                        # falling / rising.
-                        self.dy = 0
-                    break
-        return tuple(p)
+        position, vertical = self.model.world.collide(position, height, pad)
+        if vertical:
+            # You are colliding with the ground or ceiling, so stop
+            # falling / rising.
+            self.dy = 0
+        return position
 
     def on_mouse_press(self, x: int, y: int, button: int, modifiers: int):
         """
@@ -358,18 +401,15 @@ class Window(PygletWindow):
             Number representing any modifying keys that were pressed.
         """
 
-        if symbol == key.W:
-            self.strafe[0] -= 1
-        elif symbol == key.S:
-            self.strafe[0] += 1
-        elif symbol == key.A:
-            self.strafe[1] -= 1
-        elif symbol == key.D:
-            self.strafe[1] += 1
+        if symbol in self.strafe_keys:
+            axis, step = self.strafe_keys[symbol]
+            self.strafe[axis] += step
         elif symbol == key.LSHIFT:
+            self.climb -= 1
             if not self.flying:
                 self.sneaking = True
         elif symbol == key.SPACE:
+            self.climb += 1
             if not self.flying:
                 if self.dy == 0:
                     self.dy = JUMP_SPEED
@@ -382,7 +422,7 @@ class Window(PygletWindow):
         elif symbol == key.LALT:
             self.sprinting = True
         elif symbol in self.num_keys:
-            index = (symbol - self.num_keys[0]) % len(self.inventory)
+            index = self.num_keys[symbol] % len(self.inventory)
             self.block = self.inventory[index]
         elif symbol == key.F3:
             self.do_debug = not self.do_debug
@@ -400,20 +440,17 @@ class Window(PygletWindow):
             Number representing any modifying keys that were pressed.
         """
 
-        if symbol == key.W:
-            self.strafe[0] += 1
-        elif symbol == key.S:
-            self.strafe[0] -= 1
-        elif symbol == key.A:
-            self.strafe[1] += 1
-        elif symbol == key.D:
-            self.strafe[1] -= 1
+        if symbol in self.strafe_keys:
+            axis, step = self.strafe_keys[symbol]
+            self.strafe[axis] -= step
         elif symbol == key.LSHIFT:
+            self.climb += 1
             if self.flying:
                 self.dy += FLYING_Y_SPEED
             else:
                 self.sneaking = False
         elif symbol == key.SPACE:
+            self.climb -= 1
             if self.flying:
                 self.dy -= FLYING_Y_SPEED
 
@@ -447,6 +484,12 @@ class Window(PygletWindow):
             self.right_label_bg[i].y = y - height * 0.035
             y -= height * 0.03
 
+        # The text is laid out again at the new font size, so the backgrounds
+        # are refitted here. Otherwise they only change with the text.
+        for label, bg in zip(self.left_labels + self.right_labels,
+                             self.left_label_bg + self.right_label_bg):
+            self.fit_label_bg(label, bg)
+
     def set_2d(self):
         'Configure OpenGL to draw in 2d.'
         width, height = self.get_size()
@@ -471,17 +514,36 @@ class Window(PygletWindow):
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
         x, y = self.rotation
+        cos_x, sin_x, _, _ = self.rotation_trig
         glRotatef(x, 0, 1, 0)
-        glRotatef(-y, cos(radians(x)), 0, sin(radians(x)))
+        glRotatef(-y, cos_x, 0, sin_x)
         x, y, z = self.position
         glTranslatef(-x, -y, -z)
 
+    def get_frustum(self) -> np.ndarray:
+        """
+        Returns the planes of the view frustum set up by `set_3d()`. They are
+        only read back from OpenGL again when the camera has changed.
+        """
+
+        key = self.position, self.rotation, self.get_size()
+        if key == self.frustum_key:
+            return self.frustum
+        projection = (GLfloat * 16)()
+        modelview = (GLfloat * 16)()
+        glGetFloatv(GL_PROJECTION_MATRIX, projection)
+        glGetFloatv(GL_MODELVIEW_MATRIX, modelview)
+        # OpenGL matrices are column major.
+        matrix = np.reshape(projection, (4, 4)).T @ np.reshape(modelview, (4, 4)).T
+        self.frustum, self.frustum_key = frustum_planes(matrix), key
+        return self.frustum
+
     def on_draw(self):
         'Called by pyglet to draw the canvas.'
         self.clear()
         self.set_3d()
         glColor3d(1, 1, 1)
-        self.model.batch.draw()
+        self.model.draw(self.get_frustum())
         self.draw_focused_block()
         self.set_2d()
 
@@ -496,18 +558,41 @@ class Window(PygletWindow):
         crosshairs.
         """
 
-        vector = self.get_sight_vector()
-        block = self.model.hit_test(self.position, vector)[0]
-        if block:
-            x, y, z = block
-            vertex_data = cube_vertices(x, y, z, 0.51)
+        # The focused block only changes when the player moves or turns, or
+        # when a block is added or removed.
+        values = self.position, self.rotation, self.model.version
+        if values != self.focus_key:
+            self.focus_key = values
+            block = self.model.hit_test(self.position, self.get_sight_vector())[0]
+            if block != self.focused:
+                self.focused = block
+                if block:
+                    x, y, z = block
+                    cube_corners_into(x, y, z, 0.51,
+                                      np.ctypeslib.as_array(self.focus_outline.vertices))
+        if self.focused:
             glColor3d(0, 0, 0)
             glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
-            pyglet.graphics.draw(24, GL_QUADS, ('v3f/static', vertex_data))
+            self.focus_outline.draw(GL_QUADS)
             glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
 
     def draw_label(self):
         'Draw the label in the top left of the screen.'
+        values = round(clock.get_fps()), self.position, self.rotation
+        if values != self.label_values:
+            self.label_values = values
+            self.update_labels()
+
+        for label, bg in zip(self.left_labels + self.right_labels,
+                             self.left_label_bg + self.right_label_bg):
+            # Empty lines have no background.
+            if label.text:
+                bg.draw()
+
+        self.label_batch.draw()
+
+    def update_labels(self):
+        'Rebuild the text of the debug labels.'
         rot_1 = self.rotation[0] % 360
         x, y, z = self.position
         ix, iy, iz = floor(x), floor(y), floor(z)
@@ -520,44 +605,47 @@ class Window(PygletWindow):
         else:
             direction = 'west (Towards negative X)'
 
-        left_debug = f'''\
-Minecraft Python (recreation)
-{clock.get_fps():.0f} fps
-
-XYZ: {x:.3f} / {y:.5f} / {z:.3f}
-Block: {ix:d} {iy:d} {iz:d}
-Chunk: {ix%16:d} {iy%16:d} {iz%16:d} in {ix//16} {iy//16} {iz//16}
-Facing: {direction} ({rot_1:.1f} / {self.rotation[1]:.1f})\
-'''.split('\n')
+        left_debug = [
+            'Minecraft Python (recreation)',
+            f'{clock.get_fps():.0f} fps',
+            '',
+            f'XYZ: {x:.3f} / {y:.5f} / {z:.3f}',
+            f'Block: {ix:d} {iy:d} {iz:d}',
+            f'Chunk: {ix%16:d} {iy%16:d} {iz%16:d} in {ix//16} {iy//16} {iz//16}',
+            f'Facing: {direction} ({rot_1:.1f} / {self.rotation[1]:.1f})',
+        ]
 
         # len(self.model._shown), len(self.model.world)
-        for i in range(min(self.left_label_size, len(left_debug))):
-            self.left_labels[i].text = left_debug[i]
+        # Setting the text lays a label out again even when it is the same,
+        # so only the lines that changed are set.
+        for label, bg, text in zip(self.left_labels, self.left_label_bg,
+                                   left_debug):
+            if label.text != text:
+                label.text = text
+                self.fit_label_bg(label, bg)
+
+        right_debug = [
+            f'Python: {version_info.major}.{version_info.minor}.{version_info.micro}',
+        ]
 
-        for label in self.left_labels:
-            self.left_label_bg[i].width = label.content_width + self.width + 0.01
-            self.left_label_bg[i].height = label.content_height + self.height + 0.01
-            self.left_label_bg[i].x = self.width * 0.975 - self.left_label_bg[i].width
-            self.left_label_bg[i].draw()
+        # len(self.model._shown), len(self.model.world)
+        for label, bg, text in zip(self.right_labels, self.right_label_bg,
+                                   right_debug):
+            if label.text != text:
+                label.text = text
+                self.fit_label_bg(label, bg)
 
-        right_debug = f'''\
-Python: {version_info.major}.{version_info.minor}.{version_info.micro}\
-'''.split('\n')
+    def fit_label_bg(self, label: Label, bg: Rectangle):
+        """
+        Size the background `bg` of a debug `label` to its text, with a small
+        margin. The backgrounds of the left labels grow rightwards and those
+        of the right labels leftwards.
+        """
 
-        # len(self.model._shown), len(self.model.world)
-        for i in range(min(self.right_label_size, len(right_debug))):
-            self.right_labels[i].text = right_debug[i]
-
-        for label in self.right_labels:
-            self.right_label_bg[i].width = label.content_width + self.width + 0.01
-            self.right_label_bg[i].height = label.content_height + self.height + 0.01
-            self.right_label_bg[i].x = self.width * 0.975 - self.right_label_bg[i].width
-            self.right_label_bg[i].draw()
-
-        for label in self.left_labels:
-            label.draw()
-        for label in self.right_labels:
-            label.draw()
+        bg.width = label.content_width + self.width * 0.01
+        bg.height = label.content_height + self.height * 0.01
+        if label.anchor_x == 'right':
+            bg.x = self.width * 0.975 - bg.width
 
     def draw_reticle(self):
         'Draw the crosshairs in the center of the screen.'